@@ -10,11 +10,15 @@ import sqlite3
 import json
 import re
 import hashlib
+import time
 from pathlib import Path
 from queue import Queue
-from threading import Thread
+from threading import Thread, Lock, RLock
 from datetime import datetime
 import asyncio
+from contextlib import contextmanager
+from collections import namedtuple, OrderedDict
+from functools import lru_cache
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
 from telegram.error import BadRequest
@@ -36,18 +40,37 @@ WEBHOOK_URL = os.getenv('WEBHOOK_URL')
 
 MAX_USERS = 25
 MAX_GROUPS_PER_USER = 6
+SEND_RATE = 30  # Telegram allows ~30 messages/s per bot
+MAX_MESSAGE_LENGTH = 4096  # Telegram's limit per text message
+UPDATE_WORKERS = 8
+UPDATE_QUEUE_SIZE = 10_000
+EDIT_CACHE_SIZE = 4096
 DB_PATH = '/data/users.db'
+DB_READERS = 4
+DB_CACHED_STATEMENTS = 256  # prepared statements kept per connection
+USER_CACHE_TTL = 60  # seconds
+FETCH_TIMEOUT = 30  # seconds for a whole schedule download
+DB_OPTIMIZE_INTERVAL = 6 * 3600  # seconds between PRAGMA optimize runs
+DB_PRAGMAS = '''
+    PRAGMA journal_mode=WAL;
+    PRAGMA synchronous=NORMAL;
+    PRAGMA busy_timeout=5000;
+    PRAGMA temp_store=MEMORY;
+    PRAGMA cache_size=-20000;
+    PRAGMA mmap_size=67108864;
+    PRAGMA foreign_keys=ON;
+'''
 
 # City configurations
 CITIES = {
     'lviv': {
         'name': 'Львівська область',
-        'groups': [f"{i}.{j}" for i in range(1, 7) for j in range(1, 3)],  # 1.1, 1.2, 2.1, 2.2, ..., 6.2
+        'groups': tuple(f"{i}.{j}" for i in range(1, 7) for j in range(1, 3)),  # 1.1, 1.2, 2.1, 2.2, ..., 6.2
         'emoji': '🦁'
     },
     'ivano-frankivsk': {
         'name': 'Івано-Франківська область',
-        'groups': [f"{i}.{j}" for i in range(1, 7) for j in range(1, 3)],  # 1.1, 1.2, 2.1, 2.2, ..., 6.2
+        'groups': tuple(f"{i}.{j}" for i in range(1, 7) for j in range(1, 3)),  # 1.1, 1.2, 2.1, 2.2, ..., 6.2
         'emoji': '🏔'
     }
 }
@@ -57,7 +80,12 @@ logger = logging.getLogger(__name__)
 
 bot_app = None
 bot_loop = None
-update_queue = Queue()
+update_queue = asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE)  # raw webhook bodies, fed from the Flask thread
+send_semaphore = asyncio.Semaphore(SEND_RATE)  # shared by broadcasts and notifications
+
+# Persistent SQLite connections: one writer, DB_READERS readers
+_writer_pool = None
+_reader_pool = None
 
 # =============================================================================
 # KEYBOARDS
@@ -69,36 +97,57 @@ REPLY_KEYBOARD = ReplyKeyboardMarkup([
     [KeyboardButton("🏙 Області")]
 ], resize_keyboard=True)
 
+INLINE_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📋 Графік", callback_data="schedule"),
+     InlineKeyboardButton("ℹ️ Мої групи", callback_data="mygroups")],
+    [InlineKeyboardButton("➕ Додати групу", callback_data="addgroup"),
+     InlineKeyboardButton("➖ Видалити групу", callback_data="removegroup")],
+    [InlineKeyboardButton("🏙 Змінити область", callback_data="changecity")]
+])
+
+INLINE_KEYBOARD_NO_GROUPS = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🏙 Обрати область", callback_data="selectcity")]
+])
+
+CITY_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton(f"{city_info['emoji']} {city_info['name']}", callback_data=f"city_{city_id}")]
+    for city_id, city_info in CITIES.items()
+])
+
 def get_inline_keyboard(has_groups=True):
-    if has_groups:
-        return InlineKeyboardMarkup([
-            [InlineKeyboardButton("📋 Графік", callback_data="schedule"),
-             InlineKeyboardButton("ℹ️ Мої групи", callback_data="mygroups")],
-            [InlineKeyboardButton("➕ Додати групу", callback_data="addgroup"),
-             InlineKeyboardButton("➖ Видалити групу", callback_data="removegroup")],
-            [InlineKeyboardButton("🏙 Змінити область", callback_data="changecity")]
-        ])
-    else:
-        return InlineKeyboardMarkup([
-            [InlineKeyboardButton("🏙 Обрати область", callback_data="selectcity")]
-        ])
+    return INLINE_KEYBOARD if has_groups else INLINE_KEYBOARD_NO_GROUPS
 
 def get_city_keyboard():
-    buttons = []
-    for city_id, city_info in CITIES.items():
-        buttons.append([InlineKeyboardButton(
-            f"{city_info['emoji']} {city_info['name']}", 
-            callback_data=f"city_{city_id}"
-        )])
-    return InlineKeyboardMarkup(buttons)
+    return CITY_KEYBOARD
+
+def _group_rows(groups, prefix):
+    return [[InlineKeyboardButton(g, callback_data=f"{prefix}_{g}") for g in groups[i:i+3]]
+            for i in range(0, len(groups), 3)]
+
+@lru_cache(maxsize=256)
+def _add_group_keyboard(city, taken):
+    available = [g for g in CITIES[city]['groups'] if g not in taken]
+    return InlineKeyboardMarkup(_group_rows(available, 'add'))
+
+@lru_cache(maxsize=256)
+def _remove_group_keyboard(groups):
+    return InlineKeyboardMarkup(_group_rows(groups, 'rem'))
+
+def get_add_group_keyboard(city, current_groups):
+    return _add_group_keyboard(city, frozenset(current_groups))
+
+def get_remove_group_keyboard(groups):
+    return _remove_group_keyboard(tuple(groups))
 
 # =============================================================================
 # DATABASE
 # =============================================================================
 
 def init_db():
+    global _user_count
     Path(DB_PATH).parent.mkdir(parents=True, exist_ok=True)
     conn = sqlite3.connect(DB_PATH)
+    conn.executescript(DB_PRAGMAS)
     c = conn.cursor()
     
     # Users
@@ -122,6 +171,8 @@ def init_db():
         )
     ''')
     
+    c.execute('CREATE INDEX IF NOT EXISTS idx_ug_city_group ON user_groups(city, group_number, chat_id)')
+    
     # Schedules
     c.execute('''
         CREATE TABLE IF NOT EXISTS schedules (
@@ -138,62 +189,182 @@ def init_db():
     ''')
     conn.commit()
     conn.close()
-
-def db_execute(query, params=(), fetch_one=False, fetch_all=False):
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute(query, params)
     
-    result = None
-    if fetch_one:
-        result = c.fetchone()
-    elif fetch_all:
-        result = c.fetchall()
+    init_pool()
     
-    conn.commit()
-    conn.close()
-    return result
+    _user_count = db_execute('SELECT COUNT(*) FROM users', fetch_one=True)[0]
+
+def _connect():
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None, cached_statements=DB_CACHED_STATEMENTS)
+    conn.executescript(DB_PRAGMAS)
+    return conn
+
+def init_pool():
+    global _writer_pool, _reader_pool
+    _writer_pool = Queue(maxsize=1)
+    _writer_pool.put(_connect())
+    _reader_pool = Queue(maxsize=DB_READERS)
+    for _ in range(DB_READERS):
+        _reader_pool.put(_connect())
+
+@contextmanager
+def get_conn(write=False):
+    pool = _writer_pool if write else _reader_pool
+    conn = pool.get()
+    try:
+        yield conn
+    finally:
+        pool.put(conn)
+
+def optimize_db():
+    # PRAGMA optimize only analyzes tables the same connection has queried, so run it on every pooled one
+    for pool, size in ((_writer_pool, 1), (_reader_pool, DB_READERS)):
+        conns = [pool.get() for _ in range(size)]
+        try:
+            for conn in conns:
+                conn.execute('PRAGMA optimize')
+        finally:
+            for conn in conns:
+                pool.put(conn)
+
+def db_execute(query, params=(), fetch_one=False, fetch_all=False):
+    with get_conn(write=not (fetch_one or fetch_all)) as conn:
+        c = conn.execute(query, params)
+        
+        result = None
+        if fetch_one:
+            result = c.fetchone()
+        elif fetch_all:
+            result = c.fetchall()
+        else:
+            result = c.rowcount
+        return result
+
+async def adb_execute(query, params=(), fetch_one=False, fetch_all=False):
+    return await asyncio.to_thread(db_execute, query, params, fetch_one, fetch_all)
+
+# Number of rows in users, seeded by init_db and kept in step by the user writes below
+_user_count = 0
+_user_count_lock = Lock()
+
+def _adjust_user_count(delta):
+    global _user_count
+    if delta:
+        with _user_count_lock:
+            _user_count += delta
+
+def get_user_count():
+    return _user_count
+
+# Per-user lookups hit on every button press; cached with write-through from the setters below
+_city_cache = {}    # chat_id -> (city, expires_at)
+_groups_cache = {}  # chat_id -> ((city, groups), expires_at), groups of one city only
+# Per-user lock held across that user's DB read/write and cache update, so a slow
+# miss can't write back stale rows; other users never wait on it
+_user_locks = {}  # chat_id -> RLock
+
+def _user_lock(chat_id):
+    return _user_locks.setdefault(chat_id, RLock())
+
+def _cache_get(cache, key):
+    entry = cache.get(key)
+    if entry and entry[1] > time.monotonic():
+        return entry
+    return None
+
+def _cache_put(cache, key, value):
+    cache[key] = (value, time.monotonic() + USER_CACHE_TTL)
+
+def _cached_groups(chat_id, city):
+    cached = _cache_get(_groups_cache, chat_id)
+    if cached and cached[0][0] == city:
+        return list(cached[0][1])
+    return None
 
 def get_user_city(chat_id):
-    result = db_execute('SELECT city FROM users WHERE chat_id = ?', (chat_id,), fetch_one=True)
-    return result[0] if result else None
+    cached = _cache_get(_city_cache, chat_id)
+    if cached:
+        return cached[0]
+    with _user_lock(chat_id):
+        result = db_execute('SELECT city FROM users WHERE chat_id = ?', (chat_id,), fetch_one=True)
+        city = result[0] if result else None
+        _cache_put(_city_cache, chat_id, city)
+    return city
 
 def set_user_city(chat_id, city):
-    db_execute('INSERT OR IGNORE INTO users (chat_id) VALUES (?)', (chat_id,))
-    db_execute('UPDATE users SET city = ? WHERE chat_id = ?', (city, chat_id))
+    with _user_lock(chat_id):
+        _adjust_user_count(db_execute('INSERT OR IGNORE INTO users (chat_id) VALUES (?)', (chat_id,)))
+        db_execute('UPDATE users SET city = ? WHERE chat_id = ?', (city, chat_id))
+        _cache_put(_city_cache, chat_id, city)
 
 def get_user_groups(chat_id, city=None):
     if city is None:
         city = get_user_city(chat_id) or 'lviv'
     
-    rows = db_execute(
-        'SELECT group_number FROM user_groups WHERE chat_id = ? AND city = ? ORDER BY group_number', 
-        (chat_id, city), fetch_all=True
-    )
-    return [row[0] for row in rows] if rows else []
+    groups = _cached_groups(chat_id, city)
+    if groups is not None:
+        return groups
+    
+    with _user_lock(chat_id):
+        rows = db_execute(
+            'SELECT group_number FROM user_groups WHERE chat_id = ? AND city = ? ORDER BY group_number', 
+            (chat_id, city), fetch_all=True
+        )
+        groups = [row[0] for row in rows] if rows else []
+        _cache_put(_groups_cache, chat_id, (city, tuple(groups)))
+    return groups
+
+async def aget_user_city(chat_id):
+    # Cache hits stay on the loop; only misses go to a worker thread
+    cached = _cache_get(_city_cache, chat_id)
+    if cached:
+        return cached[0]
+    return await asyncio.to_thread(get_user_city, chat_id)
+
+async def aget_user_groups(chat_id, city):
+    groups = _cached_groups(chat_id, city)
+    if groups is not None:
+        return groups
+    return await asyncio.to_thread(get_user_groups, chat_id, city)
 
 def add_user_group(chat_id, city, group):
     try:
-        db_execute('INSERT OR IGNORE INTO users (chat_id, city) VALUES (?, ?)', (chat_id, city))
-        
-        current_groups = get_user_groups(chat_id, city)
-        if len(current_groups) >= MAX_GROUPS_PER_USER:
-            return False, f"Максимум {MAX_GROUPS_PER_USER} груп"
-        
-        db_execute('INSERT OR IGNORE INTO user_groups (chat_id, city, group_number) VALUES (?, ?, ?)', 
-                  (chat_id, city, group))
+        with _user_lock(chat_id):
+            _adjust_user_count(db_execute('INSERT OR IGNORE INTO users (chat_id, city) VALUES (?, ?)', (chat_id, city)))
+            # The row may or may not have been created with this city
+            _city_cache.pop(chat_id, None)
+            
+            current_groups = get_user_groups(chat_id, city)
+            if len(current_groups) >= MAX_GROUPS_PER_USER:
+                return False, f"Максимум {MAX_GROUPS_PER_USER} груп"
+            
+            db_execute('INSERT OR IGNORE INTO user_groups (chat_id, city, group_number) VALUES (?, ?, ?)', 
+                      (chat_id, city, group))
+            _cache_put(_groups_cache, chat_id, (city, tuple(sorted({*current_groups, group}))))
         return True, None
     except Exception as e:
         logger.error(f"Error adding group: {e}")
         return False, "Помилка при додаванні групи"
 
 def remove_user_group(chat_id, city, group):
-    try:
-        db_execute('DELETE FROM user_groups WHERE chat_id = ? AND city = ? AND group_number = ?', 
-                  (chat_id, city, group))
-        return True
-    except:
-        return False
+    with _user_lock(chat_id):
+        try:
+            db_execute('DELETE FROM user_groups WHERE chat_id = ? AND city = ? AND group_number = ?', 
+                      (chat_id, city, group))
+            groups = _cached_groups(chat_id, city)
+            if groups is not None:
+                _cache_put(_groups_cache, chat_id, (city, tuple(g for g in groups if g != group)))
+            return True
+        except:
+            _groups_cache.pop(chat_id, None)
+            return False
+
+def delete_user(chat_id):
+    with _user_lock(chat_id):
+        # user_groups rows go with it via ON DELETE CASCADE
+        _adjust_user_count(-db_execute('DELETE FROM users WHERE chat_id = ?', (chat_id,)))
+        _city_cache.pop(chat_id, None)
+        _groups_cache.pop(chat_id, None)
 
 def get_all_users():
     rows = db_execute('''
@@ -209,6 +380,19 @@ def get_all_users():
         result.append({"chat_id": chat_id, "city": city or 'lviv', "groups": groups})
     return result
 
+def get_group_subscribers(city, groups):
+    if not groups:
+        return []
+    qmarks = ','.join('?' * len(groups))
+    # Only subscriptions in the user's current city are notified
+    return db_execute(f'''
+        SELECT ug.chat_id, ug.group_number
+        FROM user_groups ug
+        JOIN users u ON u.chat_id = ug.chat_id AND u.city = ug.city
+        WHERE ug.city = ? AND ug.group_number IN ({qmarks})
+        ORDER BY ug.chat_id, ug.group_number
+    ''', (city, *groups), fetch_all=True)
+
 def get_schedule(city, group_number):
     result = db_execute(
         'SELECT today_schedule, tomorrow_schedule, updated_at FROM schedules WHERE city = ? AND group_number = ?', 
@@ -216,30 +400,49 @@ def get_schedule(city, group_number):
     )
     return {'today': result[0], 'tomorrow': result[1], 'updated_at': result[2]} if result else None
 
-def save_schedule(city, group_number, today, tomorrow, schedule_hash):
-    curr = db_execute(
-        'SELECT today_schedule, tomorrow_schedule FROM schedules WHERE city = ? AND group_number = ?', 
-        (city, group_number), fetch_one=True
+def get_schedules(city, groups):
+    if not groups:
+        return {}
+    qmarks = ','.join('?' * len(groups))
+    rows = db_execute(
+        f'SELECT group_number, today_schedule, tomorrow_schedule, updated_at FROM schedules WHERE city = ? AND group_number IN ({qmarks})',
+        (city, *groups), fetch_all=True
     )
-    prev_today, prev_tomorrow = (curr[0], curr[1]) if curr else (None, None)
-    
-    db_execute('''INSERT INTO schedules (city, group_number, today_schedule, tomorrow_schedule, previous_today, previous_tomorrow, schedule_hash, updated_at)
-        VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
-        ON CONFLICT(city, group_number) DO UPDATE SET
-            previous_today = schedules.today_schedule,
-            previous_tomorrow = schedules.tomorrow_schedule,
-            today_schedule = excluded.today_schedule,
-            tomorrow_schedule = excluded.tomorrow_schedule,
-            schedule_hash = excluded.schedule_hash,
-            updated_at = CURRENT_TIMESTAMP
-    ''', (city, group_number, today, tomorrow, prev_today, prev_tomorrow, schedule_hash))
-
-def get_schedule_hash(city, group_number):
-    result = db_execute(
-        'SELECT schedule_hash FROM schedules WHERE city = ? AND group_number = ?', 
-        (city, group_number), fetch_one=True
+    return {row[0]: {'today': row[1], 'tomorrow': row[2], 'updated_at': row[3]} for row in rows}
+
+def save_schedules(city, rows):
+    with get_conn(write=True) as conn:
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # previous_* of existing rows are copied by ON CONFLICT; new rows have no previous
+            conn.executemany('''INSERT INTO schedules (city, group_number, today_schedule, tomorrow_schedule, previous_today, previous_tomorrow, schedule_hash, updated_at)
+                VALUES (?, ?, ?, ?, NULL, NULL, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(city, group_number) DO UPDATE SET
+                    previous_today = schedules.today_schedule,
+                    previous_tomorrow = schedules.tomorrow_schedule,
+                    today_schedule = excluded.today_schedule,
+                    tomorrow_schedule = excluded.tomorrow_schedule,
+                    schedule_hash = excluded.schedule_hash,
+                    updated_at = CURRENT_TIMESTAMP
+            ''', [(city, group, today, tomorrow, schedule_hash) for group, today, tomorrow, schedule_hash in rows])
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+
+def get_schedule_changes(city, groups):
+    if not groups:
+        return {}
+    qmarks = ','.join('?' * len(groups))
+    rows = db_execute(
+        f'SELECT group_number, today_schedule, tomorrow_schedule, previous_today, previous_tomorrow FROM schedules WHERE city = ? AND group_number IN ({qmarks})',
+        (city, *groups), fetch_all=True
     )
-    return result[0] if result else None
+    return {row[0]: row[1:] for row in rows}
+
+def get_schedule_hashes(city):
+    rows = db_execute('SELECT group_number, schedule_hash FROM schedules WHERE city = ?', (city,), fetch_all=True)
+    return dict(rows)
 
 # =============================================================================
 # SCHEDULE PARSING
@@ -260,13 +463,20 @@ def parse_schedule_entries(group_data):
             tomorrow = schedule
     return today, tomorrow
 
+_OFF_RE = re.compile(r'з (\d{1,2}):(\d{2}) до (\d{1,2}):(\d{2})')
+
+Intervals = namedtuple('Intervals', ['on', 'off'])
+NO_INTERVALS = Intervals((), ())
+
+@lru_cache(maxsize=512)
 def extract_intervals(schedule_text):
     if not schedule_text:
-        return {'on': [], 'off': []}
+        return NO_INTERVALS
     
-    off_ranges = re.findall(r'з (\d{1,2}:\d{2}) до (\d{1,2}:\d{2})', schedule_text)
-    to_min = lambda t: int(t.split(':')[0]) * 60 + int(t.split(':')[1])
-    off_intervals = sorted([(to_min(s), to_min(e)) for s, e in off_ranges])
+    off_intervals = tuple(sorted(
+        (int(h1) * 60 + int(m1), int(h2) * 60 + int(m2))
+        for h1, m1, h2, m2 in _OFF_RE.findall(schedule_text)
+    ))
     
     on_intervals = []
     last = 0
@@ -277,23 +487,29 @@ def extract_intervals(schedule_text):
     if last < 1440:
         on_intervals.append((last, 1440))
     
-    return {'on': on_intervals, 'off': off_intervals}
+    return Intervals(tuple(on_intervals), off_intervals)
 
+# Keyed on integer minutes, so at most 1441 distinct entries
+@lru_cache(maxsize=1441)
 def fmt_time(mins):
     return "24:00" if mins >= 1440 else f"{mins // 60:02d}:{mins % 60:02d}"
 
 def fmt_hours(hours):
     return f"{hours:.1f}"
 
+_MDV2 = str.maketrans({c: f'\\{c}' for c in '_*[]()~`>#+-=|{}.!'})
+
 def esc(text):
-    for c in ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']:
-        text = text.replace(c, f'\\{c}')
-    return text
+    return text.translate(_MDV2)
+
+# City labels are static, escape them once for MarkdownV2 notifications
+CITY_LABELS_ESC = {city: (esc(info['name']), esc(info['emoji'])) for city, info in CITIES.items()}
 
 # =============================================================================
 # MESSAGE FORMATTING
 # =============================================================================
 
+@lru_cache(maxsize=256)
 def format_schedule_display(schedule_text):
     if not schedule_text:
         return "ℹ️ Інформація відсутня"
@@ -301,230 +517,380 @@ def format_schedule_display(schedule_text):
     iv = extract_intervals(schedule_text)
     lines = ["🟢 *Є світло:*"]
     
-    for s, e in iv['on']:
+    for s, e in iv.on:
         if s != e:
             lines.append(f"  • {fmt_time(s)} — {fmt_time(e)}")
-    if not iv['on']:
+    if not iv.on:
         lines.append("  • немає даних")
 
     lines.append("\n🔴 *Немає світла:*")
     total = 0
-    for s, e in iv['off']:
+    for s, e in iv.off:
         dur = e - s
         total += dur
         lines.append(f"  • {fmt_time(s)} — {fmt_time(e)} ({fmt_hours(dur/60)} год)")
-    if iv['off']:
+    if iv.off:
         lines.append(f"\n⏱ *Загалом вимкнено:* {fmt_hours(total/60)} годин")
     else:
         lines.append("  • немає даних")
 
     return "\n".join(lines)
 
+# Pre-rendered schedule displays by (city, group), refreshed by the checker
+SCHEDULE_DISPLAY_CACHE = {}
+
+def render_schedule(today, tomorrow, updated_at):
+    return {
+        'today': format_schedule_display(today) if today else None,
+        'tomorrow': format_schedule_display(tomorrow) if tomorrow else None,
+        'updated_at': updated_at
+    }
+
+def refresh_schedule_cache(city):
+    rows = db_execute(
+        'SELECT group_number, today_schedule, tomorrow_schedule, updated_at FROM schedules WHERE city = ?',
+        (city,), fetch_all=True
+    )
+    for group, today, tomorrow, updated_at in rows:
+        SCHEDULE_DISPLAY_CACHE[(city, group)] = render_schedule(today, tomorrow, updated_at)
+    # Runs in a worker thread while handlers fill _msg_cache; iterate a snapshot of the keys
+    for key in list(_msg_cache):
+        if key[0] == city:
+            _msg_cache.pop(key, None)
+
+def get_schedule_display(city, group):
+    display = SCHEDULE_DISPLAY_CACHE.get((city, group))
+    if display is None:
+        schedule = get_schedule(city, group)
+        if not schedule:
+            return None
+        display = render_schedule(schedule['today'], schedule['tomorrow'], schedule['updated_at'])
+        # A refresh may have stored a newer render meanwhile; never overwrite it
+        display = SCHEDULE_DISPLAY_CACHE.setdefault((city, group), display)
+    return display
+
+def get_schedule_displays(city, groups):
+    displays = {group: SCHEDULE_DISPLAY_CACHE.get((city, group)) for group in groups}
+    missing = [group for group, display in displays.items() if display is None]
+    # Cache misses are loaded together in one query
+    for group, schedule in get_schedules(city, missing).items():
+        display = render_schedule(schedule['today'], schedule['tomorrow'], schedule['updated_at'])
+        displays[group] = SCHEDULE_DISPLAY_CACHE.setdefault((city, group), display)
+    return displays
+
+# Rendered schedule messages by (city, group, updated_at); a city's entries are dropped on refresh
+_msg_cache = {}
+
+SCHEDULE_HEADER = "📋 *Графік вимкнень*\n\n{emoji} Область: *{city}*\n📍 Група: *{group}*\n\n"
+SCHEDULE_TODAY = "📅 *Сьогодні*\n"
+SCHEDULE_TOMORROW = "📅 *Завтра*\n"
+SCHEDULE_UPDATED = "🕐 Оновлено: _{}_\n"
+SCHEDULE_FOOTER = "ℹ️ _Графік може змінюватися протягом дня_"
+
+def schedule_message_body(city, group, schedule):
+    key = (city, group, schedule['updated_at'])
+    body = _msg_cache.get(key)
+    if body is None:
+        city_info = CITIES[city]
+        parts = [SCHEDULE_HEADER.format(emoji=city_info['emoji'], city=city_info['name'], group=group)]
+        if schedule['today']:
+            parts += (SCHEDULE_TODAY, schedule['today'], "\n\n")
+        if schedule['tomorrow']:
+            parts += (SCHEDULE_TOMORROW, schedule['tomorrow'], "\n\n")
+        if schedule['updated_at']:
+            parts.append(SCHEDULE_UPDATED.format(schedule['updated_at']))
+        body = _msg_cache[key] = "".join(parts)
+    return body
+
+def build_schedule_message(city, group, schedule):
+    return schedule_message_body(city, group, schedule) + SCHEDULE_FOOTER
+
+SCHEDULE_SEPARATOR = "\n\n━━━━━━━━━━━━━━━━━━━━\n\n"
+
+def pack_messages(parts):
+    # Join parts into as few messages as fit under Telegram's length limit
+    chunks = []
+    for part in parts:
+        if chunks and len(chunks[-1]) + len(SCHEDULE_SEPARATOR) + len(part) <= MAX_MESSAGE_LENGTH:
+            chunks[-1] += SCHEDULE_SEPARATOR + part
+        else:
+            chunks.append(part)
+    return chunks
+
+def intervals_changed(curr_today, curr_tomorrow, prev_today, prev_tomorrow):
+    # Reworded text or scraper noise that parses to the same outages isn't worth a message
+    return (extract_intervals(curr_today) != extract_intervals(prev_today)
+            or extract_intervals(curr_tomorrow) != extract_intervals(prev_tomorrow))
+
 def format_notification(city, group, curr_today, curr_tomorrow, prev_today=None, prev_tomorrow=None):
-    city_name = CITIES.get(city, {}).get('name', city)
-    city_emoji = CITIES.get(city, {}).get('emoji', '🏙')
+    city_name, city_emoji = CITY_LABELS_ESC.get(city) or (esc(city), '🏙')
     
-    msg = f"⚡️ *Оновлення графіку вимкнень\\!*\n\n{esc(city_emoji)} Область: *{esc(city_name)}*\n📍 Група: *{esc(group)}*\n\n"
+    parts = [f"⚡️ *Оновлення графіку вимкнень\\!*\n\n{city_emoji} Область: *{city_name}*\n📍 Група: *{esc(group)}*\n\n"]
     
     curr = extract_intervals(curr_today)
-    prev = extract_intervals(prev_today) if prev_today else {'on': [], 'off': []}
     
-    off_removed = [iv for iv in prev['off'] if iv not in curr['off']]
-    off_added = [iv for iv in curr['off'] if iv not in prev['off']]
-    on_removed = [iv for iv in prev['on'] if iv not in curr['on']]
-    on_added = [iv for iv in curr['on'] if iv not in prev['on']]
+    # Only tomorrow changed: today's diff is empty, skip parsing the previous text
+    if curr_today == prev_today:
+        off_removed = off_added = on_removed = on_added = ()
+    else:
+        prev = extract_intervals(prev_today)
+        prev_off, curr_off = set(prev.off), set(curr.off)
+        prev_on, curr_on = set(prev.on), set(curr.on)
+        off_removed = sorted(prev_off - curr_off)
+        off_added = sorted(curr_off - prev_off)
+        on_removed = sorted(prev_on - curr_on)
+        on_added = sorted(curr_on - prev_on)
     
     if off_removed or off_added or on_removed or on_added:
-        msg += "📊 *ЩО ЗМІНИЛОСЬ:*\n\n"
+        parts.append("📊 *ЩО ЗМІНИЛОСЬ:*\n\n")
         
         if off_removed:
-            msg += "✅ *Світло з\\'явилось:*\n"
+            parts.append("✅ *Світло з\\'явилось:*\n")
             for s, e in off_removed:
-                msg += f"  • {esc(fmt_time(s))} — {esc(fmt_time(e))}\n"
-            msg += "\n"
+                parts.append(f"  • {fmt_time(s)} — {fmt_time(e)}\n")
+            parts.append("\n")
         
         if off_added:
-            msg += "⚠️ *Нові вимкнення:*\n"
+            parts.append("⚠️ *Нові вимкнення:*\n")
             for s, e in off_added:
-                msg += f"  • {esc(fmt_time(s))} — {esc(fmt_time(e))} \\({esc(fmt_hours((e-s)/60))} год\\)\n"
-            msg += "\n"
+                parts.append(f"  • {fmt_time(s)} — {fmt_time(e)} \\({esc(fmt_hours((e-s)/60))} год\\)\n")
+            parts.append("\n")
         
         if on_removed:
-            msg += "🔻 *Прибрано періоди зі світлом:*\n"
+            parts.append("🔻 *Прибрано періоди зі світлом:*\n")
             for s, e in on_removed:
-                msg += f"  • {esc(fmt_time(s))} — {esc(fmt_time(e))}\n"
-            msg += "\n"
+                parts.append(f"  • {fmt_time(s)} — {fmt_time(e)}\n")
+            parts.append("\n")
         
         if on_added:
-            msg += "🔺 *Додано періоди зі світлом:*\n"
+            parts.append("🔺 *Додано періоди зі світлом:*\n")
             for s, e in on_added:
-                msg += f"  • {esc(fmt_time(s))} — {esc(fmt_time(e))}\n"
-            msg += "\n"
+                parts.append(f"  • {fmt_time(s)} — {fmt_time(e)}\n")
+            parts.append("\n")
         
-        msg += "━━━━━━━━━━━━━━━━━━━━\n\n"
+        parts.append("━━━━━━━━━━━━━━━━━━━━\n\n")
     
-    msg += "📅 *ПОВНИЙ ГРАФІК НА СЬОГОДНІ:*\n\n🟢 *Є світло:*\n"
-    for s, e in curr['on']:
+    parts.append("📅 *ПОВНИЙ ГРАФІК НА СЬОГОДНІ:*\n\n🟢 *Є світло:*\n")
+    for s, e in curr.on:
         if s != e:
-            msg += f"  • {esc(fmt_time(s))} — {esc(fmt_time(e))}\n"
-    if not curr['on']:
-        msg += "  • немає даних\n"
+            parts.append(f"  • {fmt_time(s)} — {fmt_time(e)}\n")
+    if not curr.on:
+        parts.append("  • немає даних\n")
     
-    msg += "\n🔴 *Немає світла:*\n"
+    parts.append("\n🔴 *Немає світла:*\n")
     total = 0
-    for s, e in curr['off']:
+    for s, e in curr.off:
         dur = e - s
         total += dur
-        msg += f"  • {esc(fmt_time(s))} — {esc(fmt_time(e))} \\({esc(fmt_hours(dur/60))} год\\)\n"
-    if curr['off']:
-        msg += f"\n⏱ *Загалом вимкнено:* {esc(fmt_hours(total/60))} годин\n"
+        parts.append(f"  • {fmt_time(s)} — {fmt_time(e)} \\({esc(fmt_hours(dur/60))} год\\)\n")
+    if curr.off:
+        parts.append(f"\n⏱ *Загалом вимкнено:* {esc(fmt_hours(total/60))} годин\n")
     else:
-        msg += "  • немає даних\n"
+        parts.append("  • немає даних\n")
     
     if curr_tomorrow:
-        msg += "\n━━━━━━━━━━━━━━━━━━━━\n\n📅 *ЗАВТРА:*\n\n"
+        parts.append("\n━━━━━━━━━━━━━━━━━━━━\n\n📅 *ЗАВТРА:*\n\n")
         tm = extract_intervals(curr_tomorrow)
         
-        msg += "🟢 *Є світло:*\n"
-        for s, e in tm['on']:
+        parts.append("🟢 *Є світло:*\n")
+        for s, e in tm.on:
             if s != e:
-                msg += f"  • {esc(fmt_time(s))} — {esc(fmt_time(e))}\n"
-        if not tm['on']:
-            msg += "  • немає даних\n"
+                parts.append(f"  • {fmt_time(s)} — {fmt_time(e)}\n")
+        if not tm.on:
+            parts.append("  • немає даних\n")
         
-        msg += "\n🔴 *Немає світла:*\n"
+        parts.append("\n🔴 *Немає світла:*\n")
         total_tm = 0
-        for s, e in tm['off']:
+        for s, e in tm.off:
             dur = e - s
             total_tm += dur
-            msg += f"  • {esc(fmt_time(s))} — {esc(fmt_time(e))} \\({esc(fmt_hours(dur/60))} год\\)\n"
-        if tm['off']:
-            msg += f"\n⏱ *Загалом вимкнено:* {esc(fmt_hours(total_tm/60))} годин\n"
+            parts.append(f"  • {fmt_time(s)} — {fmt_time(e)} \\({esc(fmt_hours(dur/60))} год\\)\n")
+        if tm.off:
+            parts.append(f"\n⏱ *Загалом вимкнено:* {esc(fmt_hours(total_tm/60))} годин\n")
         else:
-            msg += "  • немає даних\n"
+            parts.append("  • немає даних\n")
     
-    msg += "\n_Графік може змінюватися протягом дня_"
-    return msg
+    parts.append("\n_Графік може змінюватися протягом дня_")
+    return "".join(parts)
 
 # =============================================================================
 # BACKGROUND CHECKER
 # =============================================================================
 
+# Hash of the last raw payload fetched per city
+_last_payload_hash = {}
+
+async def send_messages(messages, parse_mode=None):
+    chat_locks = {chat_id: asyncio.Lock() for chat_id, _ in messages}
+    
+    async def send(chat_id, text):
+        async with chat_locks[chat_id], send_semaphore:
+            try:
+                await bot_app.bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
+            finally:
+                # Hold the slot for a second: at most SEND_RATE messages/s overall and 1/s per chat
+                await asyncio.sleep(1)
+    
+    results = await asyncio.gather(*(send(chat_id, text) for chat_id, text in messages), return_exceptions=True)
+    
+    failed_count = 0
+    for (chat_id, _), result in zip(messages, results):
+        if isinstance(result, Exception):
+            logger.error(f"Send failed for user {chat_id}: {result}")
+            failed_count += 1
+    return len(messages) - failed_count, failed_count
+
 async def broadcast_message(message, parse_mode=None):
-    users_data = db_execute('SELECT DISTINCT chat_id FROM users', fetch_all=True)
+    users_data = await adb_execute('SELECT DISTINCT chat_id FROM users', fetch_all=True)
     users = [row[0] for row in users_data]
-    success_count = 0
-    failed_count = 0
     
     logger.info(f"Starting broadcast to {len(users)} users...")
     
-    for chat_id in users:
-        try:
-            await bot_app.bot.send_message(
-                chat_id=chat_id,
-                text=message,
-                parse_mode=parse_mode
-            )
-            success_count += 1
-            await asyncio.sleep(0.1)
-        except Exception as e:
-            logger.error(f"Broadcast failed for user {chat_id}: {e}")
-            failed_count += 1
+    success_count, failed_count = await send_messages([(chat_id, message) for chat_id in users], parse_mode)
     
     logger.info(f"Broadcast complete: {success_count} sent, {failed_count} failed")
     return success_count, failed_count
 
-async def check_and_notify():
+async def process_city(city_id):
+    logger.info(f"Checking schedules for {city_id}...")
+    
+    scraper = ScheduleScraper(city=city_id)
     try:
-        for city_id in CITIES.keys():
-            logger.info(f"Checking schedules for {city_id}...")
-            
-            scraper = ScheduleScraper(city=city_id)
-            json_content = scraper.fetch_schedule()
-            if not json_content:
-                logger.warning(f"Failed to fetch schedule for {city_id}")
-                continue
-            
-            schedule = scraper.parse_schedule(json_content)
-            if not schedule:
-                logger.warning(f"Failed to parse schedule for {city_id}")
-                continue
-            
-            groups_data = schedule.get('groups', {})
-            if not groups_data:
-                logger.warning(f"No groups found for {city_id}")
-                continue
-            
-            logger.info(f"Processing {len(groups_data)} groups from {city_id}")
-            
-            changed_groups = []
-            saved_count = 0
-            for group, data in groups_data.items():
-                today, tomorrow = parse_schedule_entries(data)
-                if not today:
-                    logger.warning(f"No schedule found for {city_id} group {group}")
-                    continue
-                
-                new_hash = hashlib.sha256(f"{today}|{tomorrow or ''}".encode()).hexdigest()
-                old_hash = get_schedule_hash(city_id, group)
-                
-                save_schedule(city_id, group, today or '', tomorrow or '', new_hash)
-                saved_count += 1
-                logger.info(f"Saved schedule for {city_id} group {group}")
-                
-                if new_hash != old_hash and old_hash is not None:
-                    changed_groups.append(group)
-            
-            logger.info(f"Saved {saved_count} {city_id} groups, {len(changed_groups)} changed")
-            
-            if not changed_groups:
-                continue
-            
-            for user in get_all_users():
-                if user['city'] != city_id:
-                    continue
-                    
-                user_changed_groups = [g for g in user['groups'] if g in changed_groups]
-                
-                for group in user_changed_groups:
-                    try:
-                        result = db_execute(
-                            'SELECT today_schedule, tomorrow_schedule, previous_today, previous_tomorrow FROM schedules WHERE city = ? AND group_number = ?',
-                            (city_id, group), fetch_one=True
-                        )
-                        if result:
-                            msg = format_notification(city_id, group, result[0], result[1], result[2], result[3])
-                            await bot_app.bot.send_message(chat_id=user['chat_id'], text=msg, parse_mode='MarkdownV2')
-                            await asyncio.sleep(0.5)
-                    except Exception as e:
-                        logger.error(f"Notify error {user['chat_id']}: {e}")
-                        
-    except Exception as e:
-        logger.error(f"Checker error: {e}", exc_info=True)
+        # requests' (connect, read) timeouts are per socket operation, so a trickling body can outlast them;
+        # bound the whole download so one city can't stall the tick
+        json_content = await asyncio.wait_for(asyncio.to_thread(scraper.fetch_schedule), FETCH_TIMEOUT)
+    except asyncio.TimeoutError:
+        # wait_for can't cancel the worker thread; it runs on until requests gives up
+        logger.warning(f"Timed out fetching schedule for {city_id} after {FETCH_TIMEOUT}s, fetch thread still running")
+        return
+    if not json_content:
+        logger.warning(f"Failed to fetch schedule for {city_id}")
+        return
+    
+    payload_hash = hashlib.blake2b(json_content, digest_size=16).hexdigest()
+    if payload_hash == _last_payload_hash.get(city_id):
+        logger.info(f"No changes in {city_id} payload, skipping")
+        return
+    
+    schedule = await asyncio.to_thread(scraper.parse_schedule, json_content)
+    if not schedule:
+        logger.warning(f"Failed to parse schedule for {city_id}")
+        return
+    
+    groups_data = schedule.get('groups', {})
+    if not groups_data:
+        logger.warning(f"No groups found for {city_id}")
+        return
+    
+    logger.info(f"Processing {len(groups_data)} groups from {city_id}")
+    
+    old_hashes = await asyncio.to_thread(get_schedule_hashes, city_id)
+    changed_groups = []
+    rows = []
+    hashes = {}
+    for group, data in groups_data.items():
+        today, tomorrow = parse_schedule_entries(data)
+        if not today:
+            logger.warning(f"No schedule found for {city_id} group {group}")
+            continue
+        
+        key = (today, tomorrow)
+        if key not in hashes:
+            hashes[key] = hashlib.blake2b(f"{today}|{tomorrow or ''}".encode(), digest_size=16).hexdigest()
+        new_hash = hashes[key]
+        old_hash = old_hashes.get(group)
+        rows.append((group, today or '', tomorrow or '', new_hash))
+        
+        # Hashes saved before the switch to BLAKE2b are longer; don't notify on that one-off mismatch
+        if new_hash != old_hash and old_hash is not None and len(old_hash) == len(new_hash):
+            changed_groups.append(group)
+    
+    await asyncio.to_thread(save_schedules, city_id, rows)
+    _last_payload_hash[city_id] = payload_hash
+    try:
+        await asyncio.to_thread(refresh_schedule_cache, city_id)
+    except Exception:
+        # The new hashes are already stored; a stale display must not cost the notifications below
+        logger.exception(f"Failed to refresh {city_id} schedule cache")
+    logger.info(f"Saved {len(rows)} {city_id} groups, {len(changed_groups)} changed")
+    
+    if not changed_groups:
+        return
+    
+    # Every subscriber of a group gets the same text, so render it once per group
+    sched_by_group = await asyncio.to_thread(get_schedule_changes, city_id, changed_groups)
+    msg_cache = {
+        group: format_notification(city_id, group, *row)
+        for group, row in sched_by_group.items()
+        if intervals_changed(*row)
+    }
+    if not msg_cache:
+        logger.info(f"{city_id} changes are textual only, nothing to notify")
+        return
+    
+    recipients = await asyncio.to_thread(get_group_subscribers, city_id, list(msg_cache))
+    
+    sent, failed = await send_messages(
+        [(chat_id, msg_cache[group]) for chat_id, group in recipients], parse_mode='MarkdownV2'
+    )
+    logger.info(f"Notified {city_id}: {sent} sent, {failed} failed")
+
+async def check_and_notify():
+    # Cities are independent: fetch and process them concurrently
+    results = await asyncio.gather(*(process_city(city_id) for city_id in CITIES), return_exceptions=True)
+    for city_id, result in zip(CITIES, results):
+        if isinstance(result, Exception):
+            logger.error(f"Checker error for {city_id}: {result}", exc_info=result)
 
 async def checker_loop():
     logger.info("Fetching initial schedules...")
     await check_and_notify()
     logger.info("Initial fetch complete")
     
+    last_optimize = time.monotonic()
     while True:
         await asyncio.sleep(300)
         await check_and_notify()
+        
+        # Refresh the planner's statistics now and then, from the queries each pooled connection has run
+        if time.monotonic() - last_optimize >= DB_OPTIMIZE_INTERVAL:
+            last_optimize = time.monotonic()
+            try:
+                await asyncio.to_thread(optimize_db)
+            except sqlite3.Error as e:
+                logger.error(f"PRAGMA optimize failed: {e}")
 
 # =============================================================================
 # TELEGRAM HANDLERS
 # =============================================================================
 
+# Digest of the last content put into each (chat_id, message_id), oldest first
+_edit_cache = OrderedDict()
+
 async def safe_edit(query, text, parse_mode=None, reply_markup=None):
+    message = query.message
+    key = (message.chat.id, message.message_id) if message else None
+    digest = hashlib.blake2b(f"{parse_mode}|{text}|{reply_markup!r}".encode(), digest_size=16).digest()
+    # Re-rendering the same screen would only earn "Message is not modified"
+    if key and _edit_cache.get(key) == digest:
+        _edit_cache.move_to_end(key)
+        return
+    
     try:
         await query.edit_message_text(text=text, parse_mode=parse_mode, reply_markup=reply_markup)
     except BadRequest as e:
         if "Message is not modified" not in str(e):
             raise
+    
+    if key:
+        _edit_cache[key] = digest
+        _edit_cache.move_to_end(key)
+        if len(_edit_cache) > EDIT_CACHE_SIZE:
+            _edit_cache.popitem(last=False)
 
 async def start(update, context):
     chat_id = update.effective_chat.id
-    city = get_user_city(chat_id)
+    city = await aget_user_city(chat_id)
     
     if not city:
         await update.message.reply_text(
@@ -533,7 +899,7 @@ async def start(update, context):
         )
         return
     
-    groups = get_user_groups(chat_id, city)
+    groups = await aget_user_groups(chat_id, city)
     city_name = CITIES[city]['name']
     
     if groups:
@@ -551,52 +917,38 @@ async def start(update, context):
 
 async def show_schedule(update, context):
     chat_id = update.effective_chat.id
-    city = get_user_city(chat_id)
+    city = await aget_user_city(chat_id)
     
     if not city:
         await update.message.reply_text("❌ Спочатку оберіть область", reply_markup=get_city_keyboard())
         return
     
-    groups = get_user_groups(chat_id, city)
+    groups = await aget_user_groups(chat_id, city)
     
     if not groups:
         await update.message.reply_text("❌ Спочатку додайте групу", reply_markup=REPLY_KEYBOARD)
         return
     
     city_name = CITIES[city]['name']
-    city_emoji = CITIES[city]['emoji']
-    
-    for group in groups:
-        schedule = get_schedule(city, group)
-        if not schedule:
-            await update.message.reply_text(
-                f"ℹ️ Завантаження графіку для {city_name}, група {group}...", 
-                reply_markup=REPLY_KEYBOARD
-            )
-            continue
-        
-        msg = f"📋 *Графік вимкнень*\n\n{city_emoji} Область: *{city_name}*\n📍 Група: *{group}*\n\n"
-        if schedule['today']:
-            msg += "📅 *Сьогодні*\n" + format_schedule_display(schedule['today']) + "\n\n"
-        if schedule['tomorrow']:
-            msg += "📅 *Завтра*\n" + format_schedule_display(schedule['tomorrow']) + "\n\n"
-        if schedule['updated_at']:
-            msg += f"🕐 Оновлено: _{schedule['updated_at']}_\n"
-        msg += "ℹ️ _Графік може змінюватися протягом дня_"
-        
+    schedules = await asyncio.to_thread(get_schedule_displays, city, groups)
+    
+    parts = [
+        build_schedule_message(city, group, schedules[group]) if schedules[group]
+        else f"ℹ️ Завантаження графіку для {city_name}, група {group}..."
+        for group in groups
+    ]
+    for msg in pack_messages(parts):
         await update.message.reply_text(msg, parse_mode='Markdown', reply_markup=REPLY_KEYBOARD)
-        if len(groups) > 1:
-            await asyncio.sleep(0.3)
 
 async def show_groups(update, context):
     chat_id = update.effective_chat.id
-    city = get_user_city(chat_id)
+    city = await aget_user_city(chat_id)
     
     if not city:
         await update.message.reply_text("❌ Спочатку оберіть область", reply_markup=get_city_keyboard())
         return
     
-    groups = get_user_groups(chat_id, city)
+    groups = await aget_user_groups(chat_id, city)
     city_name = CITIES[city]['name']
     city_emoji = CITIES[city]['emoji']
     
@@ -609,7 +961,7 @@ async def show_groups(update, context):
 
 async def show_cities(update, context):
     chat_id = update.effective_chat.id
-    current_city = get_user_city(chat_id)
+    current_city = await aget_user_city(chat_id)
     
     text = "🏙 *Оберіть область:*\n\n"
     if current_city:
@@ -621,14 +973,14 @@ async def show_cities(update, context):
 
 async def add_group(update, context):
     chat_id = update.effective_chat.id
-    city = get_user_city(chat_id)
+    city = await aget_user_city(chat_id)
     
     if not city:
         await update.message.reply_text("❌ Спочатку оберіть область", reply_markup=get_city_keyboard())
         return
     
-    user_count = db_execute('SELECT COUNT(*) FROM users', fetch_one=True)[0]
-    current_groups = get_user_groups(chat_id, city)
+    user_count = get_user_count()
+    current_groups = await aget_user_groups(chat_id, city)
     
     if not current_groups and user_count >= MAX_USERS:
         await update.message.reply_text("❌ Ліміт користувачів", reply_markup=REPLY_KEYBOARD)
@@ -641,235 +993,210 @@ async def add_group(update, context):
         )
         return
     
-    available = [g for g in CITIES[city]['groups'] if g not in current_groups]
-    kb = [[InlineKeyboardButton(g, callback_data=f"add_{g}") for g in available[i:i+3]] 
-          for i in range(0, len(available), 3)]
-    
     city_name = CITIES[city]['name']
     await update.message.reply_text(
         f"Оберіть групу для додавання ({city_name}):", 
-        reply_markup=InlineKeyboardMarkup(kb)
+        reply_markup=get_add_group_keyboard(city, current_groups)
     )
 
 async def remove_group(update, context):
     chat_id = update.effective_chat.id
-    city = get_user_city(chat_id)
+    city = await aget_user_city(chat_id)
     
     if not city:
         await update.message.reply_text("❌ Спочатку оберіть область", reply_markup=get_city_keyboard())
         return
     
-    groups = get_user_groups(chat_id, city)
+    groups = await aget_user_groups(chat_id, city)
     
     if not groups:
         await update.message.reply_text("❌ У вас немає груп", reply_markup=REPLY_KEYBOARD)
         return
     
-    kb = [[InlineKeyboardButton(g, callback_data=f"rem_{g}") for g in groups[i:i+3]] 
-          for i in range(0, len(groups), 3)]
-    
     city_name = CITIES[city]['name']
     await update.message.reply_text(
         f"Оберіть групу для видалення ({city_name}):", 
-        reply_markup=InlineKeyboardMarkup(kb)
+        reply_markup=get_remove_group_keyboard(groups)
     )
 
-async def handle_callback(update, context):
-    query = update.callback_query
-    await query.answer()
-    data = query.data
-    chat_id = query.from_user.id
-    
-    if data.startswith("city_"):
-        city_id = data[5:]
-        if city_id not in CITIES:
-            await safe_edit(query, "❌ Невідома область", reply_markup=get_city_keyboard())
-            return
-        
-        set_user_city(chat_id, city_id)
-        city_name = CITIES[city_id]['name']
-        city_emoji = CITIES[city_id]['emoji']
-        
-        groups = get_user_groups(chat_id, city_id)
-        if groups:
-            await safe_edit(
-                query,
-                f"✅ Область змінено на {city_emoji} *{city_name}*\n\nВи підписані на {len(groups)} груп(у/и)\n\nОберіть дію:",
-                parse_mode='Markdown',
-                reply_markup=get_inline_keyboard(True)
-            )
-        else:
-            await safe_edit(
-                query,
-                f"✅ Область обрано: {city_emoji} *{city_name}*\n\nТепер додайте групу:",
-                parse_mode='Markdown',
-                reply_markup=get_inline_keyboard(False)
-            )
+async def _cb_city(query, context, chat_id, city_id):
+    if city_id not in CITIES:
+        await safe_edit(query, "❌ Невідома область", reply_markup=get_city_keyboard())
         return
     
-    if data.startswith("add_"):
-        city = get_user_city(chat_id)
-        if not city:
-            await safe_edit(query, "❌ Спочатку оберіть область", reply_markup=get_city_keyboard())
-            return
-        
-        group = data[4:]
-        success, error = add_user_group(chat_id, city, group)
-        
-        if success:
-            schedule = get_schedule(city, group)
-            groups = get_user_groups(chat_id, city)
-            city_name = CITIES[city]['name']
-            city_emoji = CITIES[city]['emoji']
-            
-            if schedule and schedule['today']:
-                msg = f"✅ Групу {group} додано!\n\n"
-                msg += f"📋 *Графік вимкнень*\n\n{city_emoji} Область: *{city_name}*\n📍 Група: *{group}*\n\n"
-                if schedule['today']:
-                    msg += "📅 *Сьогодні*\n" + format_schedule_display(schedule['today']) + "\n\n"
-                if schedule['tomorrow']:
-                    msg += "📅 *Завтра*\n" + format_schedule_display(schedule['tomorrow']) + "\n\n"
-                if schedule['updated_at']:
-                    msg += f"🕐 Оновлено: _{schedule['updated_at']}_\n"
-                msg += f"\n_Всього груп: {len(groups)}/{MAX_GROUPS_PER_USER}_"
-                await safe_edit(query, msg, parse_mode='Markdown', reply_markup=get_inline_keyboard(True))
-            else:
-                await safe_edit(
-                    query, 
-                    f"✅ Групу {group} додано!\n\nℹ️ Графік ще не завантажено.\n\n_Всього груп: {len(groups)}/{MAX_GROUPS_PER_USER}_", 
-                    reply_markup=get_inline_keyboard(True)
-                )
-        else:
-            await safe_edit(query, f"❌ {error}", reply_markup=get_inline_keyboard(bool(get_user_groups(chat_id, city))))
-        return
+    await asyncio.to_thread(set_user_city, chat_id, city_id)
+    city_name = CITIES[city_id]['name']
+    city_emoji = CITIES[city_id]['emoji']
     
-    if data.startswith("rem_"):
-        city = get_user_city(chat_id)
-        if not city:
-            await safe_edit(query, "❌ Спочатку оберіть область", reply_markup=get_city_keyboard())
-            return
-        
-        group = data[4:]
-        if remove_user_group(chat_id, city, group):
-            groups = get_user_groups(chat_id, city)
-            await safe_edit(
-                query, 
-                f"✅ Групу {group} видалено\n\n Залишилось груп: {len(groups)}/{MAX_GROUPS_PER_USER} ", 
-                reply_markup=get_inline_keyboard(bool(groups))
-            )
+    groups = await aget_user_groups(chat_id, city_id)
+    if groups:
+        await safe_edit(
+            query,
+            f"✅ Область змінено на {city_emoji} *{city_name}*\n\nВи підписані на {len(groups)} груп(у/и)\n\nОберіть дію:",
+            parse_mode='Markdown',
+            reply_markup=get_inline_keyboard(True)
+        )
+    else:
+        await safe_edit(
+            query,
+            f"✅ Область обрано: {city_emoji} *{city_name}*\n\nТепер додайте групу:",
+            parse_mode='Markdown',
+            reply_markup=get_inline_keyboard(False)
+        )
+
+async def _cb_add(query, context, chat_id, group):
+    city = await aget_user_city(chat_id)
+    if not city:
+        await safe_edit(query, "❌ Спочатку оберіть область", reply_markup=get_city_keyboard())
         return
     
-    if data == "schedule":
-        city = get_user_city(chat_id)
-        if not city:
-            await safe_edit(query, "❌ Спочатку оберіть область", reply_markup=get_city_keyboard())
-            return
-        
-        groups = get_user_groups(chat_id, city)
-        if not groups:
-            await safe_edit(query, "❌ Спочатку додайте групу", reply_markup=get_inline_keyboard(False))
-            return
-        
-        city_name = CITIES[city]['name']
-        city_emoji = CITIES[city]['emoji']
-        first_group = groups[0]
-        schedule = get_schedule(city, first_group)
+    success, error = await asyncio.to_thread(add_user_group, chat_id, city, group)
+    
+    if success:
+        schedule = await asyncio.to_thread(get_schedule_display, city, group)
+        groups = await aget_user_groups(chat_id, city)
         
-        if schedule:
-            msg = f"📋 *Графік вимкнень*\n\n{city_emoji} Область: *{city_name}*\n📍 Група: *{first_group}*\n\n"
-            if schedule['today']:
-                msg += "📅 *Сьогодні*\n" + format_schedule_display(schedule['today']) + "\n\n"
-            if schedule['tomorrow']:
-                msg += "📅 *Завтра*\n" + format_schedule_display(schedule['tomorrow']) + "\n\n"
-            if schedule['updated_at']:
-                msg += f"🕐 Оновлено: _{schedule['updated_at']}_\n"
-            msg += "ℹ️ _Графік може змінюватися протягом дня_"
-            
+        if schedule and schedule['today']:
+            msg = f"✅ Групу {group} додано!\n\n" + schedule_message_body(city, group, schedule)
+            msg += f"\n_Всього груп: {len(groups)}/{MAX_GROUPS_PER_USER}_"
             await safe_edit(query, msg, parse_mode='Markdown', reply_markup=get_inline_keyboard(True))
-        
-        for group in groups[1:]:
-            schedule = get_schedule(city, group)
-            if schedule:
-                msg = f"📋 *Графік вимкнень*\n\n{city_emoji} Область: *{city_name}*\n📍 Група: *{group}*\n\n"
-                if schedule['today']:
-                    msg += "📅 *Сьогодні*\n" + format_schedule_display(schedule['today']) + "\n\n"
-                if schedule['tomorrow']:
-                    msg += "📅 *Завтра*\n" + format_schedule_display(schedule['tomorrow']) + "\n\n"
-                if schedule['updated_at']:
-                    msg += f"🕐 Оновлено: _{schedule['updated_at']}_\n"
-                msg += "ℹ️ _Графік може змінюватися протягом дня_"
-                
-                await context.bot.send_message(chat_id=chat_id, text=msg, parse_mode='Markdown')
-                await asyncio.sleep(0.3)
-    
-    elif data == "mygroups":
-        city = get_user_city(chat_id)
-        if not city:
-            await safe_edit(query, "❌ Спочатку оберіть область", reply_markup=get_city_keyboard())
-            return
-        
-        groups = get_user_groups(chat_id, city)
-        city_name = CITIES[city]['name']
-        city_emoji = CITIES[city]['emoji']
-        
-        if groups:
-            groups_str = ", ".join(groups)
-            text = f"{city_emoji} *Область:* {city_name}\n📍 *Ваші групи:* {groups_str}\n\n_Ви можете мати до {MAX_GROUPS_PER_USER} груп_\n\nОберіть дію:"
         else:
-            text = f"{city_emoji} *Область:* {city_name}\n❌ Групи не обрані\n\nОберіть дію:"
-        await safe_edit(query, text, parse_mode='Markdown', reply_markup=get_inline_keyboard(bool(groups)))
-    
-    elif data == "addgroup":
-        city = get_user_city(chat_id)
-        if not city:
-            await safe_edit(query, "❌ Спочатку оберіть область", reply_markup=get_city_keyboard())
-            return
-        
-        current_groups = get_user_groups(chat_id, city)
-        
-        if len(current_groups) >= MAX_GROUPS_PER_USER:
             await safe_edit(
                 query, 
-                f"❌ Ви вже підписані на максимальну кількість груп ({MAX_GROUPS_PER_USER})",
+                f"✅ Групу {group} додано!\n\nℹ️ Графік ще не завантажено.\n\n_Всього груп: {len(groups)}/{MAX_GROUPS_PER_USER}_", 
                 reply_markup=get_inline_keyboard(True)
             )
-            return
-        
-        available = [g for g in CITIES[city]['groups'] if g not in current_groups]
-        kb = [[InlineKeyboardButton(g, callback_data=f"add_{g}") for g in available[i:i+3]] 
-              for i in range(0, len(available), 3)]
-        
-        city_name = CITIES[city]['name']
-        await safe_edit(query, f"Оберіть групу для додавання ({city_name}):", reply_markup=InlineKeyboardMarkup(kb))
-    
-    elif data == "removegroup":
-        city = get_user_city(chat_id)
-        if not city:
-            await safe_edit(query, "❌ Спочатку оберіть область", reply_markup=get_city_keyboard())
-            return
-        
-        groups = get_user_groups(chat_id, city)
-        
-        if not groups:
-            await safe_edit(query, "❌ У вас немає груп", reply_markup=get_inline_keyboard(False))
-            return
-        
-        kb = [[InlineKeyboardButton(g, callback_data=f"rem_{g}") for g in groups[i:i+3]] 
-              for i in range(0, len(groups), 3)]
-        
-        city_name = CITIES[city]['name']
-        await safe_edit(query, f"Оберіть групу для видалення ({city_name}):", reply_markup=InlineKeyboardMarkup(kb))
+    else:
+        await safe_edit(query, f"❌ {error}", reply_markup=get_inline_keyboard(bool(await aget_user_groups(chat_id, city))))
+
+async def _cb_rem(query, context, chat_id, group):
+    city = await aget_user_city(chat_id)
+    if not city:
+        await safe_edit(query, "❌ Спочатку оберіть область", reply_markup=get_city_keyboard())
+        return
     
-    elif data in ["changecity", "selectcity"]:
-        current_city = get_user_city(chat_id)
-        
-        text = "🏙 *Оберіть область:*\n\n"
-        if current_city:
-            city_name = CITIES[current_city]['name']
-            text += f"_Поточна область: {city_name}_\n\n"
-            text += "⚠️ _При зміні області ваші підписки у старій області залишаться_"
-        
-        await safe_edit(query, text, parse_mode='Markdown', reply_markup=get_city_keyboard())
+    if await asyncio.to_thread(remove_user_group, chat_id, city, group):
+        groups = await aget_user_groups(chat_id, city)
+        await safe_edit(
+            query, 
+            f"✅ Групу {group} видалено\n\n Залишилось груп: {len(groups)}/{MAX_GROUPS_PER_USER} ", 
+            reply_markup=get_inline_keyboard(bool(groups))
+        )
+
+async def _cb_schedule(query, context, chat_id):
+    city = await aget_user_city(chat_id)
+    if not city:
+        await safe_edit(query, "❌ Спочатку оберіть область", reply_markup=get_city_keyboard())
+        return
+    
+    groups = await aget_user_groups(chat_id, city)
+    if not groups:
+        await safe_edit(query, "❌ Спочатку додайте групу", reply_markup=get_inline_keyboard(False))
+        return
+    
+    schedules = await asyncio.to_thread(get_schedule_displays, city, groups)
+    messages = pack_messages([
+        build_schedule_message(city, group, schedules[group]) for group in groups if schedules[group]
+    ])
+    if not messages:
+        return
+    
+    await safe_edit(query, messages[0], parse_mode='Markdown', reply_markup=get_inline_keyboard(True))
+    for msg in messages[1:]:
+        await context.bot.send_message(chat_id=chat_id, text=msg, parse_mode='Markdown')
+
+async def _cb_mygroups(query, context, chat_id):
+    city = await aget_user_city(chat_id)
+    if not city:
+        await safe_edit(query, "❌ Спочатку оберіть область", reply_markup=get_city_keyboard())
+        return
+    
+    groups = await aget_user_groups(chat_id, city)
+    city_name = CITIES[city]['name']
+    city_emoji = CITIES[city]['emoji']
+    
+    if groups:
+        groups_str = ", ".join(groups)
+        text = f"{city_emoji} *Область:* {city_name}\n📍 *Ваші групи:* {groups_str}\n\n_Ви можете мати до {MAX_GROUPS_PER_USER} груп_\n\nОберіть дію:"
+    else:
+        text = f"{city_emoji} *Область:* {city_name}\n❌ Групи не обрані\n\nОберіть дію:"
+    await safe_edit(query, text, parse_mode='Markdown', reply_markup=get_inline_keyboard(bool(groups)))
+
+async def _cb_addgroup(query, context, chat_id):
+    city = await aget_user_city(chat_id)
+    if not city:
+        await safe_edit(query, "❌ Спочатку оберіть область", reply_markup=get_city_keyboard())
+        return
+    
+    current_groups = await aget_user_groups(chat_id, city)
+    
+    if len(current_groups) >= MAX_GROUPS_PER_USER:
+        await safe_edit(
+            query, 
+            f"❌ Ви вже підписані на максимальну кількість груп ({MAX_GROUPS_PER_USER})",
+            reply_markup=get_inline_keyboard(True)
+        )
+        return
+    
+    city_name = CITIES[city]['name']
+    await safe_edit(query, f"Оберіть групу для додавання ({city_name}):", reply_markup=get_add_group_keyboard(city, current_groups))
+
+async def _cb_removegroup(query, context, chat_id):
+    city = await aget_user_city(chat_id)
+    if not city:
+        await safe_edit(query, "❌ Спочатку оберіть область", reply_markup=get_city_keyboard())
+        return
+    
+    groups = await aget_user_groups(chat_id, city)
+    
+    if not groups:
+        await safe_edit(query, "❌ У вас немає груп", reply_markup=get_inline_keyboard(False))
+        return
+    
+    city_name = CITIES[city]['name']
+    await safe_edit(query, f"Оберіть групу для видалення ({city_name}):", reply_markup=get_remove_group_keyboard(groups))
+
+async def _cb_changecity(query, context, chat_id):
+    current_city = await aget_user_city(chat_id)
+    
+    text = "🏙 *Оберіть область:*\n\n"
+    if current_city:
+        city_name = CITIES[current_city]['name']
+        text += f"_Поточна область: {city_name}_\n\n"
+        text += "⚠️ _При зміні області ваші підписки у старій області залишаться_"
+    
+    await safe_edit(query, text, parse_mode='Markdown', reply_markup=get_city_keyboard())
+
+# Callback data is either "<prefix>_<arg>" or a bare action name
+PREFIX_CALLBACKS = {
+    'city': _cb_city,
+    'add': _cb_add,
+    'rem': _cb_rem,
+}
+
+ACTION_CALLBACKS = {
+    'schedule': _cb_schedule,
+    'mygroups': _cb_mygroups,
+    'addgroup': _cb_addgroup,
+    'removegroup': _cb_removegroup,
+    'changecity': _cb_changecity,
+    'selectcity': _cb_changecity,
+}
+
+async def handle_callback(update, context):
+    query = update.callback_query
+    await query.answer()
+    data = query.data
+    chat_id = query.from_user.id
+    
+    prefix, sep, arg = data.partition('_')
+    if sep and prefix in PREFIX_CALLBACKS:
+        await PREFIX_CALLBACKS[prefix](query, context, chat_id, arg)
+        return
+    
+    handler = ACTION_CALLBACKS.get(data)
+    if handler:
+        await handler(query, context, chat_id)
 
 async def handle_text(update, context):
     text = update.message.text
@@ -885,7 +1212,7 @@ async def handle_text(update, context):
         await show_cities(update, context)
 
 async def stop(update, context):
-    db_execute('DELETE FROM users WHERE chat_id = ?', (update.effective_chat.id,))
+    await asyncio.to_thread(delete_user, update.effective_chat.id)
     text = "✅ Ви відписані від сповіщень.\n\nЩоб підписатись знову, натисніть /start"
     await update.message.reply_text(text)
 
@@ -897,16 +1224,12 @@ flask_app = Flask(__name__)
 
 @flask_app.route('/health')
 def health():
-    count = db_execute('SELECT COUNT(*) FROM users', fetch_one=True)[0]
+    count = get_user_count()
     total_groups = db_execute('SELECT COUNT(*) FROM user_groups', fetch_one=True)[0]
     
-    city_stats = {}
-    for city_id in CITIES.keys():
-        city_users = db_execute(
-            'SELECT COUNT(DISTINCT chat_id) FROM user_groups WHERE city = ?', 
-            (city_id,), fetch_one=True
-        )[0]
-        city_stats[city_id] = city_users
+    rows = db_execute('SELECT city, COUNT(DISTINCT chat_id) FROM user_groups GROUP BY city', fetch_all=True)
+    by_city = dict(rows)
+    city_stats = {city_id: by_city.get(city_id, 0) for city_id in CITIES}
     
     return jsonify({
         'status': 'healthy', 
@@ -925,7 +1248,18 @@ def api_users():
 
 @flask_app.route('/webhook', methods=['POST'])
 def webhook():
-    update_queue.put(request.get_json(force=True))
+    if bot_loop is None:
+        return jsonify({'error': 'Bot not ready'}), 503
+    # Enqueue on the bot loop and wait for the result, so a full queue makes
+    # Telegram retry later instead of the update being dropped after a 200
+    future = asyncio.run_coroutine_threadsafe(enqueue_update(request.get_data()), bot_loop)
+    try:
+        accepted = future.result(timeout=5)
+    except TimeoutError:
+        future.cancel()
+        accepted = False
+    if not accepted:
+        return jsonify({'error': 'Busy'}), 429
     return 'OK'
 
 @flask_app.route('/api/broadcast', methods=['POST'])
@@ -952,7 +1286,7 @@ def api_broadcast():
         bot_loop
     )
     
-    user_count = db_execute('SELECT COUNT(*) FROM users', fetch_one=True)[0]
+    user_count = get_user_count()
     
     return jsonify({
         'status': 'queued',
@@ -964,20 +1298,28 @@ def api_broadcast():
 # APP SETUP
 # =============================================================================
 
+async def enqueue_update(body):
+    try:
+        update_queue.put_nowait(body)
+        return True
+    except asyncio.QueueFull:
+        logger.warning("Update queue full, asking Telegram to retry")
+        return False
+
 async def process_updates():
     while True:
-        if not update_queue.empty():
-            try:
-                data = update_queue.get()
-                update = Update.de_json(data, bot_app.bot)
-                await bot_app.process_update(update)
-            except Exception as e:
-                logger.error(f"Update error: {e}")
-        await asyncio.sleep(0.1)
+        body = await update_queue.get()
+        try:
+            update = Update.de_json(json.loads(body), bot_app.bot)
+            await bot_app.process_update(update)
+        except Exception as e:
+            logger.exception(f"Update error: {e}")
 
 async def setup():
     global bot_app
-    bot_app = Application.builder().token(BOT_TOKEN).build()
+    # PTB already pools 256 connections for Bot API calls; only wait
+    # longer for a free one during large broadcasts
+    bot_app = Application.builder().token(BOT_TOKEN).pool_timeout(20.0).build()
     
     bot_app.add_handler(CommandHandler('start', start))
     bot_app.add_handler(CommandHandler('schedule', show_schedule))
@@ -1000,7 +1342,9 @@ def run_bot():
     bot_loop = loop
     asyncio.set_event_loop(loop)
     loop.run_until_complete(setup())
-    loop.create_task(process_updates())
+    # Several workers so one slow update doesn't hold up the rest of the queue
+    for _ in range(UPDATE_WORKERS):
+        loop.create_task(process_updates())
     loop.create_task(checker_loop())
     loop.run_forever()
 
@@ -65,18 +65,13 @@ class ScheduleScraper:
                 'Accept': 'application/json'
             }
             
-            response = requests.get(self.config['api_url'], headers=headers, timeout=30)
+            # (connect, read), kept under the bot's overall FETCH_TIMEOUT
+            response = requests.get(self.config['api_url'], headers=headers, timeout=(5, 20))
             response.raise_for_status()
             
-            if self.config['source_type'] == 'github_json':
-                # GitHub returns JSON directly
-                data = response.json()
-            else:
-                # API returns structured data
-                data = response.json()
-            
+            # Return the raw body bytes; parse_schedule decodes them once
             logger.info(f"✓ Fetched {self.config['name']} schedule successfully")
-            return json.dumps(data, ensure_ascii=False)
+            return response.content
             
         except Exception as e:
             logger.error(f"Error fetching schedule from {self.config['name']}: {e}", exc_info=True)
@@ -282,7 +277,7 @@ class ScheduleScraper:
         # Save a copy of the JSON for debugging
         debug_path = f'data/last_fetch_{self.city}.json'
         os.makedirs(os.path.dirname(debug_path), exist_ok=True)
-        with open(debug_path, 'w', encoding='utf-8') as f:
+        with open(debug_path, 'wb') as f:
             f.write(json_content)
         logger.info(f"✓ Saved {self.config['name']} JSON to {debug_path} for debugging")
         